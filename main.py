@@ -1,16 +1,49 @@
-from fastapi import FastAPI, HTTPException, Depends
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, HTTPException, Depends, Header, Response, BackgroundTasks
+from fastapi.responses import ORJSONResponse
 from fastapi.security import APIKeyHeader
 from fastapi.middleware.cors import CORSMiddleware
-import requests
-from requests_oauthlib import OAuth1
+from fastapi.middleware.gzip import GZipMiddleware
+import httpx
+import orjson
+import msgspec
+import redis.asyncio as redis
 from dotenv import load_dotenv
+from contextlib import asynccontextmanager
+from functools import cached_property, lru_cache
+from urllib.parse import quote
+import asyncio
 import os
+import sys
 import time
-from cachetools import TTLCache
+import random
+import hashlib
+import hmac
+import base64
+import secrets
+import gzip
+from aiocache import Cache
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Share one pooled X API client (and the optional Redis client) across requests."""
+    app.state.http = httpx.AsyncClient(
+        http2=True,
+        timeout=10,
+        limits=httpx.Limits(max_keepalive_connections=20, max_connections=100),
+        auth=auth,
+    )
+    app.state.redis = redis.from_url(REDIS_URL) if REDIS_URL else None
+    if app.state.redis is not None:
+        app.state.throttle = app.state.redis.register_script(THROTTLE_SCRIPT)
+    yield
+    for task in prefetches:
+        task.cancel()
+    await app.state.http.aclose()
+    if app.state.redis is not None:
+        await app.state.redis.aclose()
 
 # Create the FastAPI app
-app = FastAPI(title="Tweet Likers Service")
+app = FastAPI(title="Tweet Likers Service", lifespan=lifespan, default_response_class=ORJSONResponse)
 
 # Allow cross-origin requests (for testing)
 app.add_middleware(
@@ -21,6 +54,10 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Compress larger uncached responses; cache hits carry their own gzip body
+GZIP_MIN_SIZE = 512
+app.add_middleware(GZipMiddleware, minimum_size=GZIP_MIN_SIZE)
+
 # Load credentials from .env file
 load_dotenv()
 API_KEY = os.getenv("X_API_KEY")
@@ -28,102 +65,364 @@ API_KEY_SECRET = os.getenv("X_API_KEY_SECRET")
 ACCESS_TOKEN = os.getenv("X_ACCESS_TOKEN")
 ACCESS_TOKEN_SECRET = os.getenv("X_ACCESS_TOKEN_SECRET")
 X_API_URL = "https://api.x.com/2"
+LIKERS_PARAMS = {
+    "user.fields": "id,username,name,profile_image_url",
+    "max_results": 100
+}
+
+@lru_cache(maxsize=4096)
+def liking_users_url(tweet_id: str) -> str:
+    return X_API_URL + "/tweets/" + tweet_id + "/liking_users"
 
-# Set up OAuth 1.0a for X API
-auth = OAuth1(API_KEY, API_KEY_SECRET, ACCESS_TOKEN, ACCESS_TOKEN_SECRET)
+def oauth_quote(value: str) -> str:
+    return quote(value, safe="")
+
+class OAuth1Signer(httpx.Auth):
+    """OAuth 1.0a HMAC-SHA1 request signing, with the signing key and fixed parameters built once."""
+
+    def __init__(self, consumer_key: str | None, consumer_secret: str | None, token: str | None, token_secret: str | None):
+        # Unset credentials are signed as empty strings, so the X API rejects the request
+        # (answered like any other upstream failure) instead of signing raising a TypeError
+        self.signing_key = (oauth_quote(consumer_secret or "") + "&" + oauth_quote(token_secret or "")).encode()
+        self.oauth_params = [
+            ("oauth_consumer_key", consumer_key or ""),
+            ("oauth_signature_method", "HMAC-SHA1"),
+            ("oauth_token", token or ""),
+            ("oauth_version", "1.0"),
+        ]
+
+    def auth_flow(self, request: httpx.Request):
+        oauth_params = self.oauth_params + [
+            ("oauth_nonce", secrets.token_hex(16)),
+            ("oauth_timestamp", str(int(time.time()))),
+        ]
+        params = sorted(
+            (oauth_quote(key), oauth_quote(value))
+            for key, value in request.url.params.multi_items() + oauth_params
+        )
+        base_url = str(request.url.copy_with(query=None, fragment=None))
+        base_string = "&".join((
+            request.method,
+            oauth_quote(base_url),
+            oauth_quote("&".join(f"{key}={value}" for key, value in params)),
+        ))
+        signature = base64.b64encode(hmac.new(self.signing_key, base_string.encode(), hashlib.sha1).digest()).decode()
+        oauth_params.append(("oauth_signature", signature))
+        request.headers["Authorization"] = "OAuth " + ", ".join(
+            f'{key}="{oauth_quote(value)}"' for key, value in oauth_params
+        )
+        yield request
+
+# Set up OAuth 1.0a for X API, shared by every request through the pooled client
+auth = OAuth1Signer(API_KEY, API_KEY_SECRET, ACCESS_TOKEN, ACCESS_TOKEN_SECRET)
 
 # Require an API key for client requests
 api_key_header = APIKeyHeader(name="X-API-Key")
+# Only the configured key's digest is kept; an unset API_KEY leaves the set empty and rejects every key
 VALID_API_KEY = os.getenv("API_KEY")
+VALID_API_KEY_HASHES = frozenset(
+    [hashlib.blake2b(VALID_API_KEY.encode(), digest_size=16).digest()] if VALID_API_KEY is not None else []
+)
 
 # Throttling and caching
 REQUEST_INTERVAL = 300  # 5 minutes in seconds
-last_request_time = 0
-cache = TTLCache(maxsize=100, ttl=900)  # Cache for 15 minutes
+NS_PER_SECOND = 1_000_000_000
+REQUEST_INTERVAL_NS = REQUEST_INTERVAL * NS_PER_SECOND
+last_request_ns = -REQUEST_INTERVAL_NS  # Monotonic clock, only used when Redis is not configured
+misses_reserved_until_ns = 0  # Background fetches yield the slot to refused misses until then
+CACHE_TTL = 900  # 15 minutes in seconds; stale pages are still served until then
+# Pages older than this are served but refreshed in the background. Refreshes and prefetches
+# only take the upstream slot when no cache miss is waiting for it, so polled pages can't starve misses.
+FRESH_TTL = 60
+CACHE_TTL_JITTER = 0.15  # Spread expiries by +/-15% so keys cached together don't expire together
+
+def jittered_ttl() -> float:
+    return CACHE_TTL * (1 + random.uniform(-CACHE_TTL_JITTER, CACHE_TTL_JITTER))
+
+cache = Cache(Cache.MEMORY)  # Cached pages, used only when Redis is not configured
+inflight: dict[str, asyncio.Task] = {}  # Upstream fetches in progress, by cache key
+prefetches: set[asyncio.Task] = set()  # Scheduled next-page fetches, kept so they aren't garbage collected
+refresh_after_ns: dict[str, int] = {}  # Monotonic time before which a refused refresh isn't retried, by cache key
+
+# Shared throttle and cache in Redis so every worker and host honours the same X API window
+REDIS_URL = os.getenv("REDIS_URL")
+THROTTLE_KEY = "likers:throttle"
+MISS_RESERVATION_KEY = "likers:miss-reserved"
+CACHE_KEY_PREFIX = "likers:cache:"
+# KEYS[1] is the throttle window, KEYS[2] the miss reservation; ARGV[2] is 1 for background fetches.
+# A refused miss reserves the next window so refreshes and prefetches can't take it first.
+THROTTLE_SCRIPT = """
+local background = ARGV[2] == '1'
+if background and redis.call('EXISTS', KEYS[2]) == 1 then
+  return {0, redis.call('PTTL', KEYS[2])}
+end
+local n = redis.call('INCR', KEYS[1])
+if n == 1 then
+  redis.call('EXPIRE', KEYS[1], ARGV[1])
+  if not background then redis.call('DEL', KEYS[2]) end
+elseif not background then
+  redis.call('SET', KEYS[2], 1, 'PX', redis.call('PTTL', KEYS[1]) + ARGV[1] * 1000)
+end
+return {n, redis.call('PTTL', KEYS[1])}
+"""
+
+# Response shapes, encoded straight from their slots by msgspec
+class LikersResponse(msgspec.Struct):
+    likers: list
+    meta: dict
+    next_token: str | None
+    cached: bool
+
+class ThrottledResponse(LikersResponse):
+    message: str
+
+class CachedPage(msgspec.Struct, dict=True):
+    body: bytes  # Encoded LikersResponse with cached=True
+    etag: str
+    gzip_body: bytes = b""  # Precompressed body, empty when too small to be worth compressing
+    fetched_at: float = 0.0  # Wall-clock time, so the age is comparable across workers and hosts
+
+    # Each header variant is rendered the first time it is served and then kept on the page. Pages
+    # decoded from Redis are new objects on every hit, so they only build the one variant they serve.
+    @cached_property
+    def raw_headers(self) -> list[tuple[bytes, bytes]]:
+        return [
+            (b"content-length", str(len(self.body)).encode()),
+            (b"content-type", b"application/json"),
+            (b"etag", self.etag.encode()),
+            (b"x-cache", b"HIT"),
+        ]
+
+    @cached_property
+    def gzip_raw_headers(self) -> list[tuple[bytes, bytes]]:
+        return [
+            (b"content-length", str(len(self.gzip_body)).encode()),
+            (b"content-type", b"application/json"),
+            (b"etag", self.etag.encode()),
+            (b"x-cache", b"HIT"),
+            (b"content-encoding", b"gzip"),
+            (b"vary", b"Accept-Encoding"),
+        ]
+
+    @cached_property
+    def not_modified_raw_headers(self) -> list[tuple[bytes, bytes]]:
+        return [(b"etag", self.etag.encode()), (b"x-cache", b"HIT"), (b"vary", b"Accept-Encoding")]
+
+class CachedResponse(Response):
+    """A response assembled from a cached page's prebuilt headers, skipping Response.__init__."""
+
+    def __init__(self, body: bytes, raw_headers: list[tuple[bytes, bytes]], status_code: int = 200):
+        self.status_code = status_code
+        self.body = body
+        self.background = None
+        self.raw_headers = list(raw_headers)  # Copied because middleware edits headers in place
+
+class FetchResult(msgspec.Struct):
+    """What a shared upstream fetch produced; each waiter builds its own Response from it."""
+    page: CachedPage | None = None  # Set on success, or when another fetch had already filled the cache
+    body: bytes | None = None  # Encoded cached=False response, set only when this fetch called the X API
+    wait_time: int | None = None  # Set when the throttle refused the fetch or the X API call failed
+    yielded: bool = False  # Set when a background fetch was refused; misses that joined it must claim for themselves
+
+encoder = msgspec.json.Encoder()
+page_encoder = msgspec.msgpack.Encoder()
+page_decoder = msgspec.msgpack.Decoder(CachedPage)
 
 def verify_api_key(api_key: str = Depends(api_key_header)):
-    if api_key != VALID_API_KEY:
+    if hashlib.blake2b(api_key.encode(), digest_size=16).digest() not in VALID_API_KEY_HASHES:
         raise HTTPException(status_code=401, detail="Invalid API Key")
     return api_key
 
+async def claim_request_slot(background: bool = False) -> int | None:
+    """Claim the single X API request allowed per interval, returning the seconds left to wait if it is taken."""
+    if app.state.redis is not None:
+        # The Lua script runs atomically, so only one caller per window ever sees a count of 1
+        count, ttl_ms = await app.state.throttle(
+            keys=[THROTTLE_KEY, MISS_RESERVATION_KEY], args=[REQUEST_INTERVAL, int(background)]
+        )
+        if count != 1:
+            return (max(ttl_ms, 0) + 999) // 1000
+        return None
+    return claim_local_slot(background)
+
+def wait_seconds(wait_ns: int) -> int:
+    """Round a wait up to whole seconds, so a client never retries before the slot frees up."""
+    return -(-wait_ns // NS_PER_SECOND)
+
+def claim_local_slot(background: bool = False) -> int | None:
+    """Compare-and-set the in-process throttle timestamp."""
+    # Kept synchronous on purpose: with no await between the read and the write of
+    # last_request_ns no other coroutine can interleave, so the claim is atomic
+    # without a lock and the X API call is never serialized behind it
+    global last_request_ns, misses_reserved_until_ns
+    now_ns = time.monotonic_ns()
+    if background and now_ns < misses_reserved_until_ns:
+        return wait_seconds(misses_reserved_until_ns - now_ns)
+    elapsed_ns = now_ns - last_request_ns
+    if elapsed_ns < REQUEST_INTERVAL_NS:
+        wait_ns = REQUEST_INTERVAL_NS - elapsed_ns
+        if not background:
+            # Hold the next window for misses so refreshes and prefetches can't take it first
+            misses_reserved_until_ns = now_ns + wait_ns + REQUEST_INTERVAL_NS
+        return wait_seconds(wait_ns)
+    last_request_ns = now_ns
+    if not background:
+        misses_reserved_until_ns = 0
+    return None
+
+async def cache_get(cache_key: str) -> CachedPage | None:
+    if app.state.redis is not None:
+        raw = await app.state.redis.get(CACHE_KEY_PREFIX + cache_key)
+        return None if raw is None else page_decoder.decode(raw)
+    return await cache.get(cache_key)
+
+async def cache_set(cache_key: str, page: CachedPage):
+    ttl = jittered_ttl()
+    if app.state.redis is not None:
+        await app.state.redis.setex(CACHE_KEY_PREFIX + cache_key, int(ttl), page_encoder.encode(page))
+    else:
+        await cache.set(cache_key, page, ttl=ttl)
+
+def throttled(wait_time: int) -> Response:
+    return Response(content=encoder.encode(ThrottledResponse(
+        likers=[],
+        meta={"result_count": 0},
+        next_token=None,
+        cached=False,
+        message=f"Please wait {wait_time} seconds for updated data."
+    )), media_type="application/json", status_code=429, headers={"Retry-After": str(wait_time)})
+
+def is_fresh(page: CachedPage) -> bool:
+    return time.time() - page.fetched_at < FRESH_TTL
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    """Weak-compare an ETag against an If-None-Match list, as RFC 9110 specifies for GET."""
+    if not if_none_match:
+        return False
+    opaque = etag.removeprefix("W/")
+    return any(tag.strip() == "*" or tag.strip().removeprefix("W/") == opaque for tag in if_none_match.split(","))
+
+def cache_hit(page: CachedPage, if_none_match: str | None = None, accept_encoding: str | None = None) -> Response:
+    # Polling clients that already hold this page get a bodyless 304
+    if etag_matches(if_none_match, page.etag):
+        return CachedResponse(b"", page.not_modified_raw_headers, status_code=304)
+    # GZipMiddleware passes bodies that already have a Content-Encoding through untouched
+    if page.gzip_body and accept_encoding and "gzip" in accept_encoding:
+        return CachedResponse(page.gzip_body, page.gzip_raw_headers)
+    return CachedResponse(page.body, page.raw_headers)
+
+def fetch_response(result: FetchResult, if_none_match: str | None = None, accept_encoding: str | None = None) -> Response:
+    # Middleware edits response headers in place, so a Response must never be shared between requests
+    if result.wait_time is not None:
+        return throttled(result.wait_time)
+    if result.body is not None and not etag_matches(if_none_match, result.page.etag):
+        # Send the page's ETag so the client's next poll can already be answered with a 304
+        return Response(content=result.body, media_type="application/json", headers={"ETag": result.page.etag})
+    return cache_hit(result.page, if_none_match, accept_encoding)
+
 @app.get("/likers/{tweet_id}")
-async def get_tweet_likers(tweet_id: str, next_token: str | None = None, api_key: str = Depends(verify_api_key)):
+async def get_tweet_likers(tweet_id: str, background_tasks: BackgroundTasks, next_token: str | None = None, if_none_match: str | None = Header(None), accept_encoding: str | None = Header(None), api_key: str = Depends(verify_api_key)):
     """Fetch users who liked the specified tweet, one X API request every 5 minutes, always return cached responses during cooldown."""
-    global last_request_time
     cache_key = f"{tweet_id}_{next_token or 'none'}"
 
-    # Return cached response if available
-    if cache_key in cache:
-        return JSONResponse({
-            "likers": cache[cache_key].get("data", []),
-            "meta": cache[cache_key].get("meta", {}),
-            "next_token": cache[cache_key].get("meta", {}).get("next_token"),
-            "cached": True
-        })
+    # Return cached response if available, revalidating stale pages after the response is sent
+    page = await cache_get(cache_key)
+    if page is not None:
+        if not is_fresh(page) and time.monotonic_ns() >= refresh_after_ns.get(cache_key, 0):
+            refresh_after_ns.pop(cache_key, None)
+            background_tasks.add_task(refresh_likers, tweet_id, next_token, cache_key)
+        return cache_hit(page, if_none_match, accept_encoding)
+
+    # Shield so one client disconnecting does not cancel the fetch for everyone else
+    result = await asyncio.shield(fetch_once(tweet_id, next_token, cache_key))
+    if result.yielded:
+        # This miss joined a refresh or prefetch that gave up the slot for misses, so claim it as a miss
+        result = await asyncio.shield(fetch_once(tweet_id, next_token, cache_key))
+    return fetch_response(result, if_none_match, accept_encoding)
+
+def fetch_once(tweet_id: str, next_token: str | None, cache_key: str, background: bool = False) -> asyncio.Task:
+    """Return the in-flight fetch for this key, starting one if none is running, so concurrent misses share it."""
+    task = inflight.get(cache_key)
+    if task is None or task.done():
+        task = asyncio.create_task(fetch_likers(tweet_id, next_token, cache_key, background))
+        inflight[cache_key] = task
+        # A finished task may already have been replaced by a newer fetch for the same key
+        task.add_done_callback(lambda done: inflight.get(cache_key) is done and inflight.pop(cache_key))
+    return task
+
+async def refresh_likers(tweet_id: str, next_token: str | None, cache_key: str):
+    """Re-fetch a stale page; if the throttle refuses, the stale page keeps being served."""
+    result = await fetch_once(tweet_id, next_token, cache_key, background=True)
+    if result.wait_time is not None:
+        # Stale hits skip scheduling another refresh until the slot could be free again
+        refresh_after_ns[cache_key] = time.monotonic_ns() + result.wait_time * NS_PER_SECOND
+
+async def prefetch_likers(tweet_id: str, next_token: str):
+    """Fetch the next page once the throttle window reopens, so a client walking pages gets a cache hit."""
+    await asyncio.sleep(REQUEST_INTERVAL)
+    cache_key = f"{tweet_id}_{next_token}"
+    if await cache_get(cache_key) is None:
+        await fetch_once(tweet_id, next_token, cache_key, background=True)
+
+async def fetch_likers(tweet_id: str, next_token: str | None, cache_key: str, background: bool = False) -> FetchResult:
+    """Fetch one page of likers from the X API and cache it, subject to the request throttle."""
+    # A fetch that finished while the caller was awaiting its cache lookup has already filled the cache
+    page = await cache_get(cache_key)
+    if page is not None and is_fresh(page):
+        return FetchResult(page=page)
 
     # Check throttling
-    current_time = time.time()
-    time_since_last = current_time - last_request_time
-    if time_since_last < REQUEST_INTERVAL:
-        wait_time = int(REQUEST_INTERVAL - time_since_last)
-        return JSONResponse({
-            "likers": [],
-            "meta": {"result_count": 0},
-            "next_token": None,
-            "cached": False,
-            "message": f"Please wait {wait_time} seconds for updated data."
-        }, status_code=429, headers={"Retry-After": str(wait_time)})
+    wait_time = await claim_request_slot(background)
+    if wait_time is not None:
+        return FetchResult(wait_time=wait_time, yielded=background)
+    request_ns = time.monotonic_ns()
 
     try:
-        params = {
-            "user.fields": "id,username,name,profile_image_url",
-            "max_results": 100
-        }
-        if next_token:
-            params["pagination_token"] = next_token
+        params = {**LIKERS_PARAMS, "pagination_token": next_token} if next_token else LIKERS_PARAMS
 
         # Make X API request
-        last_request_time = current_time
-        response = requests.get(
-            f"{X_API_URL}/tweets/{tweet_id}/liking_users",
-            auth=auth,
-            params=params
-        )
+        response = await app.state.http.get(liking_users_url(tweet_id), params=params)
 
         # Handle all non-200 responses
         if response.status_code != 200:
-            wait_time = int(REQUEST_INTERVAL - (time.time() - last_request_time))
-            if wait_time < 0:
+            wait_time = wait_seconds(REQUEST_INTERVAL_NS - (time.monotonic_ns() - request_ns))
+            if wait_time <= 0:
                 wait_time = REQUEST_INTERVAL
-            return JSONResponse({
-                "likers": [],
-                "meta": {"result_count": 0},
-                "next_token": None,
-                "cached": False,
-                "message": f"Please wait {wait_time} seconds for updated data."
-            }, status_code=429, headers={"Retry-After": str(wait_time)})
-
-        data = response.json()
-        cache[cache_key] = data  # Update cache
-        return JSONResponse({
-            "likers": data.get("data", []),
-            "meta": data.get("meta", {}),
-            "next_token": data.get("meta", {}).get("next_token"),
-            "cached": False
-        })
-
-    except requests.RequestException as e:
-        wait_time = int(REQUEST_INTERVAL - (time.time() - last_request_time))
-        if wait_time < 0:
+            return FetchResult(wait_time=wait_time)
+
+        data = orjson.loads(response.content)
+        meta = data.get("meta", {})
+        payload = LikersResponse(
+            likers=data.get("data", []),
+            meta=meta,
+            next_token=meta.get("next_token"),
+            cached=False
+        )
+        # Cache the encoded hit body and its ETag so cache hits skip rebuilding and re-encoding it.
+        # The tag is weak because it also labels the cached=False miss body and the gzip variant.
+        body = encoder.encode(msgspec.structs.replace(payload, cached=True))
+        etag = 'W/"' + hashlib.sha256(body).hexdigest()[:16] + '"'
+        gzip_body = gzip.compress(body) if len(body) >= GZIP_MIN_SIZE else b""
+        page = CachedPage(body=body, etag=etag, gzip_body=gzip_body, fetched_at=time.time())
+        await cache_set(cache_key, page)
+
+        # Only pages a client asked for schedule a prefetch, so one tweet can't chain through every slot
+        if not background and payload.next_token:
+            task = asyncio.create_task(prefetch_likers(tweet_id, payload.next_token))
+            prefetches.add(task)
+            task.add_done_callback(prefetches.discard)
+        return FetchResult(page=page, body=encoder.encode(payload))
+
+    except (httpx.HTTPError, orjson.JSONDecodeError) as e:
+        wait_time = wait_seconds(REQUEST_INTERVAL_NS - (time.monotonic_ns() - request_ns))
+        if wait_time <= 0:
             wait_time = REQUEST_INTERVAL
-        return JSONResponse({
-            "likers": [],
-            "meta": {"result_count": 0},
-            "next_token": None,
-            "cached": False,
-            "message": f"Please wait {wait_time} seconds for updated data."
-        }, status_code=429, headers={"Retry-After": str(wait_time)})
+        return FetchResult(wait_time=wait_time)
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # uvloop has no Windows build, so fall back to the stock asyncio loop there
+    loop = "asyncio" if sys.platform == "win32" else "uvloop"
+    # Throttle and cache state is only shared between workers when it lives in Redis
+    workers = os.cpu_count() if REDIS_URL else 1
+    uvicorn.run("main:app", host="0.0.0.0", port=8000, loop=loop, http="httptools", workers=workers)